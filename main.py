@@ -1,30 +1,89 @@
 import os
+import logging
+import numpy as np
+from functools import lru_cache
 from typing import List, Optional
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from datetime import datetime, timedelta
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import BaseModel, Field
+from pydantic_core import core_schema
+from datetime import datetime, timedelta, timezone
 from database import db, create_document, get_documents
 from bson import ObjectId
+from pymongo import ReturnDocument, WriteConcern
+from pymongo.errors import OperationFailure
 
-app = FastAPI(title="Ride Hailing Prototype API")
+try:
+    import orjson  # noqa: F401
+    DefaultResponse = ORJSONResponse
+except ImportError:  # e.g. PyPy, where orjson is not available
+    DefaultResponse = JSONResponse
+
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="Ride Hailing Prototype API", default_response_class=DefaultResponse)
+
+# Comma-separated list of allowed frontends; falls back to "*" when unset.
+# Starlette only does `origin in allow_origins`, so a set makes that O(1).
+CORS_ORIGINS = frozenset(o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()) or frozenset({"*"})
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
+# Compound so match_driver's $near + vehicle_type + available filter is served by one index
+DRIVER_GEO_INDEX = [("current_location", "2dsphere"), ("vehicle_type", 1), ("available", 1)]
+
+async def migrate_driver_locations():
+    """Convert legacy {lat, lng} driver locations to GeoJSON Points (idempotent)"""
+    await db["driver"].update_many(
+        {"current_location.lat": {"$exists": True}},
+        [{"$set": {"current_location": {
+            "type": "Point",
+            "coordinates": ["$current_location.lng", "$current_location.lat"],
+        }}}],
+    )
+
+@app.on_event("startup")
+async def ensure_indexes():
+    """Create indexes for the hot query paths (idempotent)"""
+    if db is None:
+        return
+    # Don't let an unreachable database stop the app from booting; /test reports it
+    try:
+        # Legacy pairs would be indexed with lat as x, so convert before indexing
+        await migrate_driver_locations()
+        await db["driver"].create_index([("vehicle_type", 1), ("available", 1)])
+        await db["driver"].create_index(DRIVER_GEO_INDEX)
+        await db["ride"].create_index([("status", 1)])
+        await db["queueticket"].create_index([("booth_id", 1), ("issued_at", -1)])
+    except Exception as e:
+        logger.error("Index setup failed; match_driver will retry the geo index on demand: %s", e)
+
 # Utility
+_HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+
 class ObjectIdStr(str):
     @classmethod
-    def __get_validators__(cls):
-        yield cls.validate
+    def __get_pydantic_core_schema__(cls, source_type, handler):
+        # JSON input is a plain string schema (so OpenAPI can describe it); Python
+        # input may also be a bson ObjectId
+        return core_schema.json_or_python_schema(
+            json_schema=core_schema.no_info_after_validator_function(cls.validate, core_schema.str_schema()),
+            python_schema=core_schema.no_info_plain_validator_function(cls.validate),
+            serialization=core_schema.to_string_ser_schema(),
+        )
 
     @classmethod
     def validate(cls, v):
+        # Fast path: a 24-char hex string only needs lowercasing, skip the bson round-trip
+        if isinstance(v, str) and len(v) == 24 and all(c in _HEX_DIGITS for c in v):
+            return v.lower()
         if isinstance(v, ObjectId):
             return str(v)
         try:
@@ -33,13 +92,12 @@ class ObjectIdStr(str):
             raise ValueError("Invalid ObjectId")
 
 # Simple fare calculation (No surge)
-PER_KM = {"auto": 12.0, "taxi": 20.0}
-PER_MIN = {"auto": 1.5, "taxi": 2.0}
-BASE_FARE = {"auto": 20.0, "taxi": 40.0}
+# vehicle_type -> (base fare, per km rate, per min rate)
+VEHICLE_CONFIG = {"auto": (20.0, 12.0, 1.5), "taxi": (40.0, 20.0, 2.0)}
 
 class Coordinate(BaseModel):
-    lat: float
-    lng: float
+    lat: float = Field(..., ge=-90, le=90)
+    lng: float = Field(..., ge=-180, le=180)
 
 class Location(BaseModel):
     name: Optional[str] = None
@@ -63,7 +121,7 @@ def root():
     return {"message": "Ride Hailing Backend Running", "no_surge": True}
 
 @app.get("/test")
-def test_database():
+async def test_database():
     """Quick DB check"""
     response = {
         "backend": "✅ Running",
@@ -79,7 +137,7 @@ def test_database():
             response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
             response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections
                 response["connection_status"] = "Connected"
                 response["database"] = "✅ Connected & Working"
@@ -91,62 +149,63 @@ def test_database():
         response["database"] = f"❌ Error: {str(e)[:80]}"
     return response
 
+def _fare(base: float, dist: float, per_km: float, t: float, per_min: float) -> float:
+    """Total fare for the given rates, rounded to paise"""
+    return round(base + dist*per_km + t*per_min, 2)
+
 @app.post("/api/fare", response_model=FareResp)
 def calculate_fare(req: FareReq):
-    vt = req.vehicle_type
-    if vt not in PER_KM:
+    cfg = VEHICLE_CONFIG.get(req.vehicle_type)
+    if cfg is None:
         raise HTTPException(status_code=400, detail="Invalid vehicle type")
-    base = BASE_FARE[vt]
-    dist_cost = req.distance_km * PER_KM[vt]
-    time_cost = req.time_min * PER_MIN[vt]
-    total = round(base + dist_cost + time_cost, 2)
+    base, per_km, per_min = cfg
+    total = _fare(base, req.distance_km, per_km, req.time_min, per_min)
     return FareResp(
         base_fare=base,
         distance_km=req.distance_km,
-        per_km_rate=PER_KM[vt],
+        per_km_rate=per_km,
         time_min=req.time_min,
-        per_min_rate=PER_MIN[vt],
+        per_min_rate=per_min,
         total=total,
     )
 
-# Mock driver pool in DB if empty; store as driver collection
-from schemas import Driver, Ride, Booth, QueueTicket, ScheduledRide
+DRIVER_LIST_FIELDS = {"_id": 1, "name": 1, "vehicle_type": 1, "vehicle_number": 1, "available": 1, "rating": 1}
 
 @app.get("/api/drivers")
-def list_drivers(vt: Optional[str] = None):
+async def list_drivers(vt: Optional[str] = None):
     filt = {}
     if vt:
         filt["vehicle_type"] = vt
-    drivers = get_documents("driver", filt, limit=50)
-    return [
-        {
-            **{k: v for k, v in d.items() if k != "_id"},
-            "id": str(d["_id"]),
-        }
-        for d in drivers
-    ]
+    drivers = await get_documents("driver", filt, limit=50, projection=DRIVER_LIST_FIELDS)
+    for d in drivers:
+        d["id"] = str(d.pop("_id"))
+    return drivers
+
+# Static seed documents, already in the shape Driver/Booth(...).model_dump() produces
+SEED_DRIVERS = [
+    {"name": "Ravi", "phone": "9000000001", "vehicle_type": "auto", "vehicle_number": "KA-01-AR-1234", "verified": True, "rating": 4.8, "total_rides": 0, "earnings": 0.0, "current_location": {"type": "Point", "coordinates": [77.5946, 12.9716]}, "available": True, "assigned_ride_id": None},
+    {"name": "Sunita", "phone": "9000000002", "vehicle_type": "taxi", "vehicle_number": "KA-02-TC-9876", "verified": True, "rating": 4.8, "total_rides": 0, "earnings": 0.0, "current_location": {"type": "Point", "coordinates": [77.59, 12.975]}, "available": True, "assigned_ride_id": None},
+    {"name": "Imran", "phone": "9000000003", "vehicle_type": "auto", "vehicle_number": "KA-05-AR-4567", "verified": True, "rating": 4.8, "total_rides": 0, "earnings": 0.0, "current_location": {"type": "Point", "coordinates": [77.6, 12.969]}, "available": True, "assigned_ride_id": None},
+]
+SEED_BOOTHS = [
+    {"name": "MG Road Metro", "location": {"name": "MG Road", "coordinate": {"lat": 12.975, "lng": 77.605}}, "queue_count": 0},
+    {"name": "Majestic Bus Stand", "location": {"name": "Majestic", "coordinate": {"lat": 12.978, "lng": 77.572}}, "queue_count": 0},
+]
 
 @app.post("/api/seed")
-def seed_data():
+async def seed_data():
     """Seed a few drivers and booths if none exist"""
     created = {"drivers": 0, "booths": 0}
-    if db["driver"].count_documents({}) == 0:
-        sample = [
-            Driver(name="Ravi", phone="9000000001", vehicle_type="auto", vehicle_number="KA-01-AR-1234", current_location={"lat":12.9716,"lng":77.5946}).model_dump(),
-            Driver(name="Sunita", phone="9000000002", vehicle_type="taxi", vehicle_number="KA-02-TC-9876", current_location={"lat":12.975,"lng":77.59}).model_dump(),
-            Driver(name="Imran", phone="9000000003", vehicle_type="auto", vehicle_number="KA-05-AR-4567", current_location={"lat":12.969,"lng":77.6}).model_dump(),
-        ]
-        for s in sample:
-            create_document("driver", s)
-            created["drivers"] += 1
-    if db["booth"].count_documents({}) == 0:
-        booths = [
-            Booth(name="MG Road Metro", location={"name":"MG Road", "coordinate":{"lat":12.975,"lng":77.605}}, queue_count=0).model_dump(),
-            Booth(name="Majestic Bus Stand", location={"name":"Majestic", "coordinate":{"lat":12.978,"lng":77.572}}, queue_count=0).model_dump(),
-        ]
-        for b in booths:
-            create_document("booth", b)
-            created["booths"] += 1
+    now = datetime.now(timezone.utc)
+    if await db["driver"].count_documents({}) == 0:
+        # Copy so insert_many's _id assignment never touches the constants
+        sample = [dict(d, created_at=now, updated_at=now) for d in SEED_DRIVERS]
+        await db["driver"].insert_many(sample, ordered=False)
+        created["drivers"] = len(sample)
+    if await db["booth"].count_documents({}) == 0:
+        booths = [dict(b, created_at=now, updated_at=now) for b in SEED_BOOTHS]
+        await db["booth"].insert_many(booths, ordered=False)
+        created["booths"] = len(booths)
     return {"seeded": created}
 
 class RideRequest(BaseModel):
@@ -158,37 +217,75 @@ class RideRequest(BaseModel):
     fixed_booth_id: Optional[str] = None
 
 @app.post("/api/ride/request")
-def request_ride(req: RideRequest):
-    # Create ride with status requested
-    ride = Ride(
-        rider_name=req.rider_name,
-        rider_phone=req.rider_phone,
-        pickup=req.pickup,
-        drop=req.drop,
-        vehicle_type=req.vehicle_type,
-        fixed_booth_id=req.fixed_booth_id,
-    ).model_dump()
-    ride_id = create_document("ride", ride)
+async def request_ride(req: RideRequest):
+    if req.vehicle_type not in VEHICLE_CONFIG:
+        raise HTTPException(status_code=400, detail="Invalid vehicle type")
+    # Create ride with status requested; req is already validated, so build the
+    # document directly instead of re-validating it through Ride
+    ride = req.model_dump()
+    ride.update({
+        "status": "requested",
+        "driver_id": None,
+        "driver_name": None,
+        "driver_phone": None,
+        "driver_vehicle_number": None,
+        "fare": None,
+        "route_points": None,
+        "route_index": 0,
+    })
+    ride_id = await create_document("ride", ride)
     return {"ride_id": ride_id, "status": "requested"}
 
 @app.get("/api/ride/{ride_id}")
-def get_ride(ride_id: str):
-    r = db["ride"].find_one({"_id": ObjectId(ride_id)})
+async def get_ride(ride_id: str, include_route: bool = False):
+    # route_points is served by /simulate; only ship it here when asked for
+    projection = None if include_route else {"route_points": 0}
+    r = await db["ride"].find_one({"_id": ObjectId(ride_id)}, projection)
     if not r:
         raise HTTPException(status_code=404, detail="Ride not found")
     r["id"] = str(r.pop("_id"))
     return r
 
+MATCH_RADIUS_M = 5000
+
+async def claim_driver(ride_id: str, vehicle_type: str, pickup: dict):
+    """Atomically claim the nearest available driver of this type for ride_id.
+
+    $near needs the 2dsphere index; if it is missing (e.g. startup could not
+    build it) try to build it now, and if that fails too, fall back to claiming
+    any available driver rather than failing the match.
+    """
+    filt = {"vehicle_type": vehicle_type, "available": True}
+    near = {"$near": {
+        "$geometry": {"type": "Point", "coordinates": [pickup["lng"], pickup["lat"]]},
+        "$maxDistance": MATCH_RADIUS_M,
+    }}
+    claim = dict(
+        update={"$set": {"available": False, "assigned_ride_id": ride_id}},
+        projection={"name": 1, "phone": 1, "vehicle_number": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    try:
+        return await db["driver"].find_one_and_update({**filt, "current_location": near}, **claim)
+    except OperationFailure as e:
+        logger.warning("Nearest-driver query failed, rebuilding driver geo index: %s", e)
+    try:
+        await db["driver"].create_index(DRIVER_GEO_INDEX)
+        return await db["driver"].find_one_and_update({**filt, "current_location": near}, **claim)
+    except OperationFailure as e:
+        logger.error("Driver geo index unavailable, matching without proximity: %s", e)
+    return await db["driver"].find_one_and_update(filt, **claim)
+
 @app.post("/api/ride/match/{ride_id}")
-def match_driver(ride_id: str):
-    r = db["ride"].find_one({"_id": ObjectId(ride_id)})
+async def match_driver(ride_id: str):
+    r = await db["ride"].find_one({"_id": ObjectId(ride_id)}, {"vehicle_type": 1, "pickup.coordinate": 1})
     if not r:
         raise HTTPException(status_code=404, detail="Ride not found")
-    driver = db["driver"].find_one({"vehicle_type": r["vehicle_type"], "available": True})
+    # Claim atomically so concurrent matches cannot pick the same driver
+    driver = await claim_driver(str(r["_id"]), r["vehicle_type"], r["pickup"]["coordinate"])
     if not driver:
         raise HTTPException(status_code=404, detail="No drivers available")
-    db["driver"].update_one({"_id": driver["_id"]}, {"$set": {"available": False}})
-    db["ride"].update_one(
+    await db["ride"].update_one(
         {"_id": r["_id"]},
         {"$set": {
             "status": "driver_en_route",
@@ -200,52 +297,78 @@ def match_driver(ride_id: str):
     )
     return {"status": "driver_en_route"}
 
+@lru_cache(maxsize=4096)
+def _interpolate(lat1: float, lng1: float, lat2: float, lng2: float, steps: int = 30):
+    """Straight-line (lat, lng) points between two coordinates, memoized per endpoint pair"""
+    t = np.linspace(0, 1, steps + 1)
+    lat = np.round(lat1*(1-t) + lat2*t, 6)
+    lng = np.round(lng1*(1-t) + lng2*t, 6)
+    return tuple(zip(lat.tolist(), lng.tolist()))
+
 @app.get("/api/ride/simulate/{ride_id}")
-def simulate_route(ride_id: str):
+async def simulate_route(ride_id: str):
     """Create a simple straight-line route between pickup and drop with 30 points"""
-    r = db["ride"].find_one({"_id": ObjectId(ride_id)})
+    r = await db["ride"].find_one({"_id": ObjectId(ride_id)}, {"pickup.coordinate": 1, "drop.coordinate": 1})
     if not r:
         raise HTTPException(status_code=404, detail="Ride not found")
     p1 = r["pickup"]["coordinate"]
     p2 = r["drop"]["coordinate"]
-    steps = 30
-    points = []
-    for i in range(steps + 1):
-        t = i/steps
-        lat = p1["lat"]*(1-t) + p2["lat"]*t
-        lng = p1["lng"]*(1-t) + p2["lng"]*t
-        points.append({"lat": round(lat,6), "lng": round(lng,6)})
-    db["ride"].update_one({"_id": r["_id"]}, {"$set": {"route_points": points, "route_index": 0}})
+    points = [{"lat": a, "lng": b} for a, b in _interpolate(p1["lat"], p1["lng"], p2["lat"], p2["lng"])]
+    await db["ride"].update_one({"_id": r["_id"]}, {"$set": {"route_points": points, "route_index": 0}})
     return {"points": points}
 
 @app.post("/api/ride/tick/{ride_id}")
-def progress_ride(ride_id: str):
-    r = db["ride"].find_one({"_id": ObjectId(ride_id)})
+async def progress_ride(ride_id: str):
+    r = await db["ride"].find_one({"_id": ObjectId(ride_id)}, {"route_points": 1})
     if not r:
         raise HTTPException(status_code=404, detail="Ride not found")
-    idx = r.get("route_index", 0)
     points = r.get("route_points")
     if not points:
         raise HTTPException(status_code=400, detail="No route to follow; call /simulate first")
-    if idx < len(points) - 1:
-        idx += 1
-        status = "ongoing" if idx > 1 else r.get("status", "driver_en_route")
-        db["ride"].update_one({"_id": r["_id"]}, {"$set": {"route_index": idx, "status": status}})
-        return {"status": status, "position": points[idx], "progress": idx/(len(points)-1)}
+    last = len(points) - 1
+    # Advance server-side and derive status from the incremented index, so
+    # concurrent ticks cannot write a stale status; the filter fails once the
+    # end of the route is reached
+    advanced = await db["ride"].find_one_and_update(
+        {"_id": r["_id"], "route_index": {"$lt": last}},
+        [
+            {"$set": {"route_index": {"$add": ["$route_index", 1]}}},
+            {"$set": {"status": {"$cond": [
+                {"$gt": ["$route_index", 1]},
+                "ongoing",
+                {"$ifNull": ["$status", "driver_en_route"]},
+            ]}}},
+        ],
+        projection={"route_index": 1, "status": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if advanced:
+        idx = advanced["route_index"]
+        return {"status": advanced["status"], "position": points[idx], "progress": idx/last}
     else:
-        # complete ride
-        db["ride"].update_one({"_id": r["_id"]}, {"$set": {"status": "completed"}})
-        # free driver
-        if r.get("driver_id"):
+        # End of route: complete the ride exactly once, later ticks are no-ops
+        completed = await db["ride"].find_one_and_update(
+            {"_id": r["_id"], "status": {"$ne": "completed"}},
+            {"$set": {"status": "completed"}},
+            projection={"driver_id": 1},
+        )
+        # free driver, but only while still assigned to this ride; a re-simulated
+        # ride can complete again after its driver was claimed by another ride
+        if completed and completed.get("driver_id"):
             try:
-                db["driver"].update_one({"_id": ObjectId(r["driver_id"])}, {"$set": {"available": True}})
+                await db["driver"].update_one(
+                    # None also covers drivers claimed before assigned_ride_id existed
+                    {"_id": ObjectId(completed["driver_id"]), "available": False,
+                     "assigned_ride_id": {"$in": [str(r["_id"]), None]}},
+                    {"$set": {"available": True}, "$unset": {"assigned_ride_id": ""}},
+                )
             except Exception:
                 pass
         return {"status": "completed"}
 
 @app.get("/api/booths")
-def get_booths():
-    booths = get_documents("booth", {}, limit=100)
+async def get_booths():
+    booths = await get_documents("booth", {}, limit=100)
     for b in booths:
         b["id"] = str(b.pop("_id"))
     return booths
@@ -255,14 +378,22 @@ class QueueRequest(BaseModel):
     phone: Optional[str] = None
 
 @app.post("/api/booths/queue")
-def get_queue_number(req: QueueRequest):
-    booth = db["booth"].find_one({"_id": ObjectId(req.booth_id)})
+async def get_queue_number(req: QueueRequest):
+    # Server-side $inc hands out each number exactly once under concurrency
+    booth = await db["booth"].find_one_and_update(
+        {"_id": ObjectId(req.booth_id)},
+        {"$inc": {"queue_count": 1}},
+        return_document=ReturnDocument.AFTER,
+    )
     if not booth:
         raise HTTPException(status_code=404, detail="Booth not found")
-    next_no = int(booth.get("queue_count", 0)) + 1
-    db["booth"].update_one({"_id": booth["_id"]}, {"$set": {"queue_count": next_no}})
-    ticket = {"booth_id": req.booth_id, "number": next_no, "issued_at": datetime.utcnow(), "phone": req.phone}
-    create_document("queueticket", ticket)
+    next_no = booth["queue_count"]
+    now = datetime.now(timezone.utc)
+    ticket = {"booth_id": req.booth_id, "number": next_no, "issued_at": now, "phone": req.phone,
+              "created_at": now, "updated_at": now}
+    # Ticket rows are a best-effort log; the booth's queue_count is authoritative,
+    # so don't wait for the server to acknowledge the write
+    await db["queueticket"].with_options(write_concern=WriteConcern(w=0)).insert_one(ticket)
     return {"queue_number": next_no}
 
 class ScheduleReq(BaseModel):
@@ -272,7 +403,7 @@ class ScheduleReq(BaseModel):
     scheduled_for: datetime
 
 @app.post("/api/schedule")
-def schedule_pickup(req: ScheduleReq):
+async def schedule_pickup(req: ScheduleReq):
     doc = req.model_dump()
-    create_document("scheduledride", doc)
+    await create_document("scheduledride", doc)
     return {"scheduled": True}
@@ -5,7 +5,7 @@ Each Pydantic model corresponds to a MongoDB collection where the collection
 name is the lowercase of the class name (e.g., Ride -> "ride").
 """
 from pydantic import BaseModel, Field
-from typing import Optional, List, Literal
+from typing import Optional, List, Literal, Tuple
 from datetime import datetime
 
 # Shared types
@@ -13,6 +13,11 @@ class Coordinate(BaseModel):
     lat: float = Field(..., ge=-90, le=90)
     lng: float = Field(..., ge=-180, le=180)
 
+class GeoPoint(BaseModel):
+    """GeoJSON Point, as indexed by MongoDB's 2dsphere index"""
+    type: Literal['Point'] = 'Point'
+    coordinates: Tuple[float, float]  # [lng, lat] -- GeoJSON order
+
 class Location(BaseModel):
     name: Optional[str] = Field(None, description="Human readable name")
     coordinate: Coordinate
@@ -32,8 +37,9 @@ class Driver(BaseModel):
     rating: float = 4.8
     total_rides: int = 0
     earnings: float = 0.0
-    current_location: Coordinate
+    current_location: GeoPoint
     available: bool = True
+    assigned_ride_id: Optional[str] = None  # ride currently holding this driver
 
 class Booth(BaseModel):
     name: str